@@ -1,8 +1,15 @@
 import boto3
+import orjson
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 
-import json
-from datetime import datetime
+import gzip
+import io
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
 # --- Configuration ---
 # Replace with your DynamoDB table name
@@ -11,8 +18,22 @@ DYNAMODB_TABLE_NAME = "trips"
 # Replace with your S3 bucket name and desired output file path
 S3_BUCKET_NAME = "trips-kpis-buckets-125"
 
+# Number of parallel scan segments (one worker thread each) and the page size
+# requested from DynamoDB per scan call
+TOTAL_SEGMENTS = 8
+SCAN_PAGE_SIZE = 1000
+
+# Multipart settings for S3 uploads: reports above the threshold are split into
+# 16 MiB parts that are uploaded in parallel
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=8,
+    use_threads=True,
+)
+
 # Create a better organized path with full timestamp for efficient access
-# Format: daily_kpis/YEAR/MONTH/DAY/YYYY-MM-DD-HH-MM-SS-daily_trip_kpis.json
+# Format: daily_kpis/YEAR/MONTH/DAY/YYYY-MM-DD-HH-MM-SS-daily_trip_kpis.json.gz
 now = datetime.now()
 year = now.strftime("%Y")
 month = now.strftime("%m")
@@ -20,186 +41,371 @@ day = now.strftime("%d")
 timestamp = now.strftime("%Y-%m-%d-%H-%M-%S")
 
 # Organize in a hierarchical structure for efficient access
-S3_OUTPUT_KEY = f"daily_kpis/{year}/{month}/{day}/{timestamp}-daily_trip_kpis.json"
+S3_OUTPUT_KEY = f"daily_kpis/{year}/{month}/{day}/{timestamp}-daily_trip_kpis.json.gz"
+
+# Per-day partial aggregates from previous runs. The S3 object metadata records
+# the upper bound of the processing window that run covered, so the next run
+# only scans trips completed after it. Kept outside the daily_kpis/ prefix so
+# crawlers and tables over the published reports never pick it up.
+S3_CHECKPOINT_KEY = "kpi_checkpoints/daily_trip_kpis.parquet"
+
+# Each run covers completed trips whose processing_timestamp_lambda2 falls in
+# (previous upper bound, now - WATERMARK_LAG_SECONDS]. Lambda 2 stamps a trip
+# just before its transaction commits, so a stamp can precede the commit by up
+# to one Lambda 2 invocation. The lag must stay comfortably above Lambda 2's
+# timeout (at most 15 minutes), or trips committed after the scan passed them
+# would fall behind the watermark and never be counted.
+WATERMARK_LAG_SECONDS = 30 * 60
 
 # --- AWS Clients ---
-dynamodb = boto3.client("dynamodb")
-s3 = boto3.client("s3")
+# botocore configuration shared by the DynamoDB and S3 clients. Each client
+# gets its own pool, sized for the busier of the scan segment threads and the
+# concurrent multipart upload threads
+BOTO3_CONFIG = Config(
+    max_pool_connections=max(TOTAL_SEGMENTS, S3_TRANSFER_CONFIG.max_concurrency),
+    retries={"mode": "adaptive", "max_attempts": 10},
+    tcp_keepalive=True,
+    connect_timeout=3,
+    read_timeout=30,
+)
+
+dynamodb = boto3.client("dynamodb", config=BOTO3_CONFIG)
+s3 = boto3.client("s3", config=BOTO3_CONFIG)
+
+
+# --- Function to scan a single segment of a DynamoDB table ---
+def scan_table_segment(
+    table_name: str,
+    segment: int,
+    total_segments: int,
+    since_ts: str | None = None,
+    until_ts: str | None = None,
+) -> tuple[list, list, list]:
+    """
+    Scans one segment of a DynamoDB table, following pagination until the
+    segment is exhausted.
+
+    Only the attributes needed for the KPIs are read, straight from the raw
+    DynamoDB wire format into one list per column.
+
+    Args:
+        table_name (str): Name of the DynamoDB table to scan
+        segment (int): Zero-based segment number handled by this worker
+        total_segments (int): Total number of segments the scan is split into
+        since_ts (str, optional): Only return completed trips processed after
+            this ISO timestamp. Defaults to None, which sets no lower bound
+        until_ts (str, optional): Only return completed trips processed at or
+            before this ISO timestamp. Defaults to None, which sets no upper bound
+
+    Returns:
+        tuple: Three lists of equal length for this segment:
+            - trip_id strings
+            - pickup_datetime strings
+            - fare_amount number strings
+    """
+
+    trip_ids = []
+    pickups = []
+    fares = []
+    scan_kwargs = {
+        "TableName": table_name,
+        "Segment": segment,
+        "TotalSegments": total_segments,
+        "Limit": SCAN_PAGE_SIZE,
+    }
+    conditions = []
+    values = {}
+    if since_ts:
+        conditions.append("processing_timestamp_lambda2 > :since_ts")
+        values[":since_ts"] = {"S": since_ts}
+    if until_ts:
+        conditions.append("processing_timestamp_lambda2 <= :until_ts")
+        values[":until_ts"] = {"S": until_ts}
+    if conditions:
+        scan_kwargs["FilterExpression"] = " AND ".join(conditions)
+        scan_kwargs["ExpressionAttributeValues"] = values
+
+    while True:
+        response = dynamodb.scan(**scan_kwargs)
+
+        # Missing attributes become None and are coerced to NaN/NaT later
+        for item in response.get("Items", []):
+            trip_ids.append(item.get("trip_id", {}).get("S"))
+            pickups.append(item.get("pickup_datetime", {}).get("S"))
+            fares.append(item.get("fare_amount", {}).get("N"))
+
+        last_evaluated_key = response.get("LastEvaluatedKey")
+
+        if not last_evaluated_key:
+            break  # No more items in this segment
+
+        scan_kwargs["ExclusiveStartKey"] = last_evaluated_key
+
+    print(f"Segment {segment}/{total_segments}: retrieved {len(trip_ids)} items.")
+    return trip_ids, pickups, fares
+
+
+# --- Function to parse pickup timestamps ---
+def parse_pickup_datetimes(pickups: list) -> pa.Array:
+    """
+    Parses pickup_datetime strings into an Arrow timestamp array.
+
+    Arrow's ISO 8601 cast is used when every value parses; otherwise the
+    strings go through pandas so that unparseable values become nulls
+    instead of failing the whole column.
+
+    Args:
+        pickups (list): pickup_datetime strings, or None for missing values
+
+    Returns:
+        pa.Array: Timestamps with nulls for missing or invalid values
+    """
+    try:
+        return pc.cast(pa.array(pickups, type=pa.string()), pa.timestamp("us"))
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        return pa.array(pd.to_datetime(pickups, errors="coerce", format="ISO8601"))
 
 
 # --- Function to read data from DynamoDB ---
-def scan_dynamodb_table(table_name: str) -> pd.DataFrame:
+def scan_dynamodb_table(
+    table_name: str, since_ts: str | None = None, until_ts: str | None = None
+) -> pa.Table:
     """
-    Scans a DynamoDB table and returns all items as a pandas DataFrame.
+    Scans a DynamoDB table and returns all items as a pyarrow Table.
+
+    The table is split into TOTAL_SEGMENTS parallel scan segments, each
+    handled by its own worker thread. The columns are built directly as Arrow
+    arrays with pickup_datetime parsed to timestamps and fare_amount to
+    float64; values that cannot be parsed become nulls.
 
     Args:
         table_name (str): Name of the DynamoDB table to scan
+        since_ts (str, optional): Only return completed trips processed after
+            this ISO timestamp. Defaults to None, which sets no lower bound
+        until_ts (str, optional): Only return completed trips processed at or
+            before this ISO timestamp. Defaults to None, which sets no upper bound
 
     Returns:
-        pd.DataFrame: DataFrame containing all items from the DynamoDB table
-            or None if there's an error
+        pa.Table: Table with trip_id, pickup_datetime and fare_amount columns
+            for all items in the table, or None if there's an error
     """
 
-    print(f"Scanning DynamoDB table: {table_name}")
-    items = []
-    last_evaluated_key = None
+    print(f"Scanning DynamoDB table: {table_name} ({TOTAL_SEGMENTS} segments)")
+    trip_ids = []
+    pickups = []
+    fares = []
 
-    while True:
-        try:
-            if last_evaluated_key:
-                response = dynamodb.scan(
-                    TableName=table_name, ExclusiveStartKey=last_evaluated_key
-                )
-            else:
-                response = dynamodb.scan(TableName=table_name)
-
-            # Convert DynamoDB item format to standard Python dicts
-            # This requires knowing the expected data types (S for String, N for Number)
-            for item in response.get("Items", []):
-                # Example conversion - adjust based on your actual schema
-                processed_item = {}
-                for key, value in item.items():
-                    if "S" in value:
-                        processed_item[key] = value["S"]
-                    elif "N" in value:
-                        processed_item[key] = float(
-                            value["N"]
-                        )  # Convert Number to float
-                    # Add other types (BOOL, L, M, etc.) as needed
-                    # For simplicity, we'll focus on S and N for this script's needs
-
-                # Ensure required keys exist, even if None
-                processed_item["trip_id"] = processed_item.get("trip_id")
-                processed_item["pickup_datetime"] = processed_item.get(
-                    "pickup_datetime"
-                )
-                processed_item["fare_amount"] = processed_item.get("fare_amount")
+    try:
+        with ThreadPoolExecutor(max_workers=TOTAL_SEGMENTS) as executor:
+            segment_results = executor.map(
+                lambda segment: scan_table_segment(
+                    table_name, segment, TOTAL_SEGMENTS, since_ts, until_ts
+                ),
+                range(TOTAL_SEGMENTS),
+            )
+            for segment_trip_ids, segment_pickups, segment_fares in segment_results:
+                trip_ids.extend(segment_trip_ids)
+                pickups.extend(segment_pickups)
+                fares.extend(segment_fares)
+
+        table = pa.table(
+            {
+                "trip_id": pa.array(trip_ids, type=pa.string()),
+                "pickup_datetime": parse_pickup_datetimes(pickups),
+                # DynamoDB validates N values, so the cast cannot fail; float64
+                # keeps the published max/min fares exactly as stored
+                "fare_amount": pc.cast(pa.array(fares, type=pa.string()), pa.float64()),
+            }
+        )
 
-                items.append(processed_item)
+    except Exception as e:
+        print(f"Error scanning DynamoDB table {table_name}: {e}")
+        # Depending on error handling needs, you might want to exit or retry
+        return None  # Return None to indicate failure
 
-            last_evaluated_key = response.get("LastEvaluatedKey")
+    print(f"Finished scanning. Total items retrieved: {table.num_rows}")
+    return table
 
-            if not last_evaluated_key:
-                break  # No more items to scan
 
-            print(f"Scanned {len(items)} items so far. Continuing scan...")
+# --- Function to load the KPI checkpoint from S3 ---
+def load_kpi_checkpoint() -> tuple[pd.DataFrame | None, str | None]:
+    """
+    Loads the per-day partial aggregates written by the previous run.
 
-        except Exception as e:
-            print(f"Error scanning DynamoDB table {table_name}: {e}")
-            # Depending on error handling needs, you might want to exit or retry
-            return None  # Return None to indicate failure
+    Returns:
+        tuple: A tuple containing:
+            - DataFrame of partial aggregates per pickup_date, or None if there
+              is no checkpoint yet
+            - ISO upper bound of the processing window the previous run
+              covered, or None
+    """
+    try:
+        response = s3.get_object(Bucket=S3_BUCKET_NAME, Key=S3_CHECKPOINT_KEY)
+    except s3.exceptions.NoSuchKey:
+        print("No KPI checkpoint found. Running a full scan.")
+        return None, None
+
+    # Without a watermark the checkpoint cannot be combined with a scan
+    # without counting its trips twice, so it is ignored
+    last_run_ts = response["Metadata"].get("last-run-ts")
+    if not last_run_ts:
+        print("KPI checkpoint has no last-run-ts. Running a full scan.")
+        return None, None
+
+    checkpoint_df = pd.read_parquet(io.BytesIO(response["Body"].read()))
+    print(
+        f"Loaded KPI checkpoint with {len(checkpoint_df)} days (last run: {last_run_ts})."
+    )
+    return checkpoint_df, last_run_ts
+
+
+# --- Function to save the KPI checkpoint to S3 ---
+def save_kpi_checkpoint(partial_df: pd.DataFrame, until_ts: str) -> None:
+    """
+    Writes the per-day partial aggregates as the checkpoint for the next run.
 
-    print(f"Finished scanning. Total items retrieved: {len(items)}")
-    return items
+    Args:
+        partial_df (pd.DataFrame): Partial aggregates per pickup_date
+        until_ts (str): ISO upper bound of the processing window this run covered
+    """
+    buffer = io.BytesIO()
+    partial_df.to_parquet(buffer, index=False)
+    s3.put_object(
+        Bucket=S3_BUCKET_NAME,
+        Key=S3_CHECKPOINT_KEY,
+        Body=buffer.getvalue(),
+        ContentType="application/vnd.apache.parquet",
+        Metadata={"last-run-ts": until_ts},
+    )
+    print(f"Saved KPI checkpoint to s3://{S3_BUCKET_NAME}/{S3_CHECKPOINT_KEY}")
 
 
 # --- Main Script Logic ---
 if __name__ == "__main__":
-    # 1. Read data from DynamoDB
-    dynamodb_items = scan_dynamodb_table(DYNAMODB_TABLE_NAME)
-
-    if not dynamodb_items:
+    # 1. Load the partial aggregates of previous runs
+    try:
+        checkpoint_df, last_run_ts = load_kpi_checkpoint()
+    except Exception as e:
+        print(f"Error loading KPI checkpoint, running a full scan instead: {e}")
+        checkpoint_df, last_run_ts = None, None
+
+    # Upper bound of this run's processing window; trips stamped after it are
+    # left for the next run, whose window starts exactly here
+    until_ts = (
+        datetime.now(timezone.utc) - timedelta(seconds=WATERMARK_LAG_SECONDS)
+    ).isoformat(timespec="microseconds")
+
+    # 2. Read data from DynamoDB into a pyarrow Table, only the trips
+    # completed since the previous run if there is a checkpoint
+    table = scan_dynamodb_table(
+        DYNAMODB_TABLE_NAME, since_ts=last_run_ts, until_ts=until_ts
+    )
+
+    if table is None or (table.num_rows == 0 and checkpoint_df is None):
         print("No data retrieved from DynamoDB or an error occurred. Exiting.")
         exit()  # Exit the script if no data
 
-    # 2. Load data into Pandas DataFrame
+    # 3. Drop rows with unusable values
     try:
-        df = pd.DataFrame(dynamodb_items)
-        print(f"Loaded {len(df)} items into Pandas DataFrame.")
-        print("DataFrame head:")
-        print(df.head())
-        print("DataFrame info:")
-        df.info()
-
-        # Ensure required columns exist and have appropriate types
-        if (
-            "pickup_datetime" not in df.columns
-            or "fare_amount" not in df.columns
-            or "trip_id" not in df.columns
-        ):
-            print(
-                "Error: Required columns ('pickup_datetime', 'fare_amount', 'trip_id') not found in DataFrame."
-            )
-            exit()
-
-        # Convert pickup_datetime to datetime objects
-        # Use errors='coerce' to turn unparseable dates into NaT (Not a Time)
-        df["pickup_datetime"] = pd.to_datetime(df["pickup_datetime"], errors="coerce")
+        print(f"Loaded {table.num_rows} items into a pyarrow Table.")
+        print("Table schema:")
+        print(table.schema)
+        print("Table head:")
+        print(table.slice(0, 5).to_pandas())
 
         # Drop rows where pickup_datetime could not be parsed
-        df.dropna(subset=["pickup_datetime"], inplace=True)
-        print(f"DataFrame after dropping rows with invalid pickup_datetime: {len(df)}")
-
-        # Convert fare_amount to numeric, coercing errors
-        df["fare_amount"] = pd.to_numeric(df["fare_amount"], errors="coerce")
+        table = table.filter(pc.is_valid(table["pickup_datetime"]))
+        print(
+            f"Table after dropping rows with invalid pickup_datetime: {table.num_rows}"
+        )
 
         # Drop rows where fare_amount could not be converted to numeric
-        df.dropna(subset=["fare_amount"], inplace=True)
-        print(f"DataFrame after dropping rows with invalid fare_amount: {len(df)}")
+        table = table.filter(pc.is_valid(table["fare_amount"]))
+        print(f"Table after dropping rows with invalid fare_amount: {table.num_rows}")
 
     except Exception as e:
-        print(f"Error creating Pandas DataFrame or processing columns: {e}")
+        print(f"Error processing table columns: {e}")
         exit()
 
-    # 3. Calculate KPIs using the user's logic
+    # 4. Calculate KPIs using the user's logic
     try:
         print("Calculating KPIs...")
-        df["pickup_date"] = df["pickup_datetime"].dt.date
-
-        # KPI 1: total fare per day
-        total_fare_per_day = (
-            df.groupby("pickup_date")["fare_amount"].sum().reset_index()
+        # Truncate to whole days as an Arrow date32 column
+        table = table.append_column(
+            "pickup_date", pc.cast(table["pickup_datetime"], pa.date32())
         )
-        total_fare_per_day.rename(columns={"fare_amount": "total_fare"}, inplace=True)
-        print("Calculated total fare per day.")
-
-        # KPI 2: count of trips
-        count_of_trips = df.groupby("pickup_date")["trip_id"].count().reset_index()
-        count_of_trips.rename(columns={"trip_id": "trip_count"}, inplace=True)
-        print("Calculated count of trips.")
 
-        # KPI 3: average fare
-        average_fare = df.groupby("pickup_date")["fare_amount"].mean().reset_index()
-        average_fare.rename(columns={"fare_amount": "average_fare"}, inplace=True)
-        print("Calculated average fare.")
+        # All partial aggregates in one grouped pass; counts skip nulls so
+        # trip_count only counts trip_ids
+        aggregated = (
+            table.group_by("pickup_date")
+            .aggregate(
+                [
+                    ("fare_amount", "sum"),
+                    ("trip_id", "count"),
+                    ("fare_amount", "count"),
+                    ("fare_amount", "max"),
+                    ("fare_amount", "min"),
+                ]
+            )
+            .sort_by("pickup_date")
+        )
 
-        # KPI 4: maximum fare
-        maximum_fare = df.groupby("pickup_date")["fare_amount"].max().reset_index()
-        maximum_fare.rename(columns={"fare_amount": "maximum_fare"}, inplace=True)
-        print("Calculated maximum fare.")
+        # Only the small per-day result is converted to pandas; pickup_date
+        # becomes datetime64 rather than Python date objects
+        partial_df = aggregated.to_pandas(date_as_object=False).rename(
+            columns={
+                "fare_amount_sum": "total_fare",
+                "trip_id_count": "trip_count",
+                "fare_amount_count": "fare_count",
+                "fare_amount_max": "maximum_fare",
+                "fare_amount_min": "minimum_fare",
+            }
+        )
 
-        # KPI 5: minimum fare
-        minimum_fare = df.groupby("pickup_date")["fare_amount"].min().reset_index()
-        minimum_fare.rename(columns={"fare_amount": "minimum_fare"}, inplace=True)
-        print("Calculated minimum fare.")
+        # Fold in the aggregates of previous runs; pickup_date stays a
+        # datetime64 column so the groupby hashes int64 keys, not strings
+        if checkpoint_df is not None:
+            partial_df = (
+                pd.concat([checkpoint_df, partial_df], ignore_index=True)
+                .groupby("pickup_date", as_index=False)
+                .agg(
+                    total_fare=("total_fare", "sum"),
+                    trip_count=("trip_count", "sum"),
+                    fare_count=("fare_count", "sum"),
+                    maximum_fare=("maximum_fare", "max"),
+                    minimum_fare=("minimum_fare", "min"),
+                )
+            )
 
-    except Exception as e:
-        print(f"Error calculating KPIs: {e}")
-        exit()
+        # The mean is derived from the merged sums rather than merged itself
+        kpi_df = pd.DataFrame(
+            {
+                "pickup_date": partial_df["pickup_date"],
+                "total_fare": partial_df["total_fare"],
+                "trip_count": partial_df["trip_count"],
+                "average_fare": partial_df["total_fare"] / partial_df["fare_count"],
+                "maximum_fare": partial_df["maximum_fare"],
+                "minimum_fare": partial_df["minimum_fare"],
+            }
+        )
+        record_count = int(partial_df["fare_count"].sum())
+        print("Calculated total, count, average, maximum and minimum fare per day.")
 
-    # 4. Combine KPIs into a single DataFrame
-    try:
-        print("Combining KPIs...")
-        # Start with one KPI and merge others
-        kpi_df = total_fare_per_day
-        kpi_df = pd.merge(kpi_df, count_of_trips, on="pickup_date", how="left")
-        kpi_df = pd.merge(kpi_df, average_fare, on="pickup_date", how="left")
-        kpi_df = pd.merge(kpi_df, maximum_fare, on="pickup_date", how="left")
-        kpi_df = pd.merge(kpi_df, minimum_fare, on="pickup_date", how="left")
-
-        print("Combined KPI DataFrame head:")
+        print("KPI DataFrame head:")
         print(kpi_df.head())
 
     except Exception as e:
-        print(f"Error combining KPIs: {e}")
+        print(f"Error calculating KPIs: {e}")
         exit()
 
     # 5. Format the output as JSON instead of CSV
     try:
         print("Formatting output as JSON...")
 
-        # Convert dates to string format for JSON serialization
-        kpi_df["pickup_date"] = kpi_df["pickup_date"].astype(str)
+        # Convert dates to string format for JSON serialization, on the small
+        # aggregated frame only
+        kpi_df["pickup_date"] = kpi_df["pickup_date"].dt.strftime("%Y-%m-%d")
 
         # Structure the JSON as an object with a "daily_kpis" array and enhanced metadata
         now = datetime.now()
@@ -212,12 +418,12 @@ if __name__ == "__main__":
                 "report_date": now.strftime("%Y-%m-%d"),
                 "report_time": now.strftime("%H:%M:%S"),
                 "source_table": DYNAMODB_TABLE_NAME,
-                "record_count": len(df),
+                "record_count": record_count,
                 "date_range": {
-                    "start_date": str(df["pickup_date"].min())
+                    "start_date": kpi_df["pickup_date"].iloc[0]
                     if not kpi_df.empty
                     else None,
-                    "end_date": str(df["pickup_date"].max())
+                    "end_date": kpi_df["pickup_date"].iloc[-1]
                     if not kpi_df.empty
                     else None,
                 },
@@ -226,8 +432,11 @@ if __name__ == "__main__":
             "daily_kpis": kpi_df.to_dict(orient="records"),
         }
 
-        # Convert to JSON string with indentation for readability
-        json_content = json.dumps(json_structure, indent=2)
+        # Convert to indented JSON bytes for readability; orjson also serializes
+        # any NumPy scalars left in the records
+        json_content = orjson.dumps(
+            json_structure, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY
+        )
         print("JSON content generated.")
 
     except Exception as e:
@@ -239,33 +448,39 @@ if __name__ == "__main__":
         print(f"Uploading JSON to S3: s3://{S3_BUCKET_NAME}/{S3_OUTPUT_KEY}")
 
         # Add content type and additional metadata for better organization and discoverability
-        s3.put_object(
+        report_metadata = {
+            "report-date": datetime.now().strftime("%Y-%m-%d"),
+            "source-table": DYNAMODB_TABLE_NAME,
+            "record-count": str(record_count),
+            "report-type": "daily-trip-kpis",
+        }
+
+        # Compress once (the repetitive JSON shrinks several times over) and let
+        # the transfer manager split large reports into concurrent parts. The
+        # object is stored as a plain .json.gz file without Content-Encoding, so
+        # HTTP clients don't decompress it behind the reader's back
+        compressed_content = gzip.compress(json_content, compresslevel=6)
+        s3.upload_fileobj(
+            io.BytesIO(compressed_content),
             Bucket=S3_BUCKET_NAME,
             Key=S3_OUTPUT_KEY,
-            Body=json_content,
-            ContentType="application/json",
-            Metadata={
-                "report-date": datetime.now().strftime("%Y-%m-%d"),
-                "source-table": DYNAMODB_TABLE_NAME,
-                "record-count": str(len(df)),
-                "report-type": "daily-trip-kpis",
+            ExtraArgs={
+                "ContentType": "application/gzip",
+                "Metadata": report_metadata,
             },
+            Config=S3_TRANSFER_CONFIG,
         )
 
-        # If needed, also write a "latest" version to a fixed path for easy access
-        latest_key = "daily_kpis/latest/daily_trip_kpis.json"
-        s3.put_object(
+        # If needed, also write a "latest" version to a fixed path for easy access.
+        # The copy happens server-side, so the report is not uploaded twice.
+        latest_key = "daily_kpis/latest/daily_trip_kpis.json.gz"
+        s3.copy_object(
             Bucket=S3_BUCKET_NAME,
             Key=latest_key,
-            Body=json_content,
-            ContentType="application/json",
-            Metadata={
-                "report-date": datetime.now().strftime("%Y-%m-%d"),
-                "source-table": DYNAMODB_TABLE_NAME,
-                "record-count": str(len(df)),
-                "report-type": "daily-trip-kpis",
-                "original-path": S3_OUTPUT_KEY,
-            },
+            CopySource={"Bucket": S3_BUCKET_NAME, "Key": S3_OUTPUT_KEY},
+            ContentType="application/gzip",
+            Metadata={**report_metadata, "original-path": S3_OUTPUT_KEY},
+            MetadataDirective="REPLACE",
         )
 
         print(f"Successfully uploaded KPI results to S3 at {S3_OUTPUT_KEY}")
@@ -275,4 +490,12 @@ if __name__ == "__main__":
         print(f"Error uploading to S3: {e}")
         exit()
 
+    # 7. Save the merged aggregates for the next incremental run
+    try:
+        save_kpi_checkpoint(partial_df, until_ts)
+
+    except Exception as e:
+        print(f"Error saving KPI checkpoint: {e}")
+        exit()
+
     print("Glue job finished.")
@@ -1,20 +1,47 @@
 import json
 import boto3
 import os
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from decimal import Decimal
 import uuid
 
-# Initialize DynamoDB resources
-dynamodb = boto3.resource("dynamodb")
+# Worker threads used for the per-record counterpart queries and transactions
+MAX_WORKERS = 10
+
+# botocore configuration for the DynamoDB client: one pooled connection per
+# worker thread, adaptive retries and TCP keepalive
+BOTO3_CONFIG = Config(
+    max_pool_connections=MAX_WORKERS,
+    retries={"mode": "adaptive", "max_attempts": 10},
+    tcp_keepalive=True,
+    connect_timeout=3,
+    read_timeout=30,
+)
 
 # Get DynamoDB table name from environment variables
 DYNAMODB_TABLE_NAME = os.environ.get("DYNAMODB_TABLE_NAME")
 if not DYNAMODB_TABLE_NAME:
     print("Error: DYNAMODB_TABLE_NAME environment variable not set.")
 
-table = dynamodb.Table(DYNAMODB_TABLE_NAME)
+# Initialize the DynamoDB client once per container; transient errors and
+# throttling are retried by botocore with adaptive backoff. The low-level
+# client is used (rather than a resource) because it is safe to share between
+# the worker threads. Items are marshalled with module-level (de)serializers.
+dynamodb_client = boto3.client("dynamodb", config=BOTO3_CONFIG)
+serializer = TypeSerializer()
+deserializer = TypeDeserializer()
+
+# Event attributes that are not copied onto the completed trip record
+EXCLUDED_EVENT_ATTRIBUTES = frozenset(
+    ("PK", "SK", "status", "processing_timestamp_lambda1")
+)
 
+# Attributes that both events carry with the same meaning, so they are never
+# prefixed with 'end_' when merged
+SHARED_TRIP_ATTRIBUTES = frozenset(("trip_id", "data_type"))
 
 # --- Helper class for DynamoDB item serialization ---
 class DecimalEncoder(json.JSONEncoder):
@@ -46,14 +73,24 @@ def find_counterpart_event(trip_id: str, data_type: str) -> dict | None:
 
     try:
         # Query for counterpart events using PK = trip_id and SK beginning with the counterpart prefix
-        response = table.query(
+        # Only the first match is used. The whole item is fetched, so the completed
+        # trip carries the same attributes whichever event arrived first
+        response = dynamodb_client.query(
+            TableName=DYNAMODB_TABLE_NAME,
             KeyConditionExpression="PK = :pk AND begins_with(SK, :sk_prefix)",
-            ExpressionAttributeValues={":pk": trip_id, ":sk_prefix": sk_prefix},
+            ExpressionAttributeValues={
+                ":pk": {"S": trip_id},
+                ":sk_prefix": {"S": sk_prefix},
+            },
+            Limit=1,
         )
 
         if response["Items"]:
-            # Return the first matching counterpart
-            return response["Items"][0]
+            # Return the first matching counterpart as a regular Python dict
+            return {
+                key: deserializer.deserialize(value)
+                for key, value in response["Items"][0].items()
+            }
         else:
             print(f"No counterpart {counterpart_data_type} found for trip_id {trip_id}")
             return None
@@ -87,89 +124,214 @@ def create_completed_trip(start_event: dict, end_event: dict) -> dict:
         "dropoff_datetime", datetime.now(timezone.utc).isoformat()
     )
 
-    # Create a basic completed trip record
-    completed_trip = {
+    # Copy all attributes from both events (except the ones handled separately)
+    start_attributes = {
+        k: v for k, v in start_event.items() if k not in EXCLUDED_EVENT_ATTRIBUTES
+    }
+    end_attributes = {
+        k: v for k, v in end_event.items() if k not in EXCLUDED_EVENT_ATTRIBUTES
+    }
+
+    # If a key already exists from the start event, prefix the end event's copy
+    # to avoid collision
+    collisions = (
+        start_attributes.keys() & end_attributes.keys()
+    ) - SHARED_TRIP_ATTRIBUTES
+
+    # Keep a correlation ID already carried by the start event, otherwise add a
+    # unique one for tracing
+    correlation = {}
+    if "correlation_id" not in start_attributes:
+        correlation["correlation_id"] = uuid.uuid4().hex
+
+    return {
+        **correlation,
+        **start_attributes,
+        **{
+            (f"end_{k}" if k in collisions else k): v
+            for k, v in end_attributes.items()
+        },
         "PK": trip_id,
         "SK": f"COMPLETED#{dropoff_datetime}",
         "trip_id": trip_id,
         "status": "completed",
-        "processing_timestamp_lambda2": datetime.now(timezone.utc).isoformat(),
-        "correlation_id": str(uuid.uuid4()),  # Add a unique correlation ID for tracing
+        "data_type": "completed_trip",
     }
 
-    # Copy all attributes from start event (except certain ones we'll handle differently)
-    for key, value in start_event.items():
-        if key not in ["PK", "SK", "status", "processing_timestamp_lambda1"]:
-            completed_trip[key] = value
-
-    # Copy all attributes from end event (except certain ones we'll handle differently)
-    for key, value in end_event.items():
-        if key not in ["PK", "SK", "status", "processing_timestamp_lambda1"]:
-            # If the key already exists from the start event, prefix it to avoid collision
-            if key in completed_trip and key not in ["trip_id", "data_type"]:
-                completed_trip[f"end_{key}"] = value
-            else:
-                completed_trip[key] = value
 
-    # Set the data_type to 'completed_trip'
-    completed_trip["data_type"] = "completed_trip"
+# --- Helper Function to Marshal a Status Change ---
+def build_status_values(new_status: str, processed_at: str) -> dict:
+    """
+    Builds the marshalled ExpressionAttributeValues for a status update, so
+    they can be built once per batch and shared by every update in it.
+
+    Args:
+        new_status (str): The new status to set for the items
+        processed_at (str): ISO timestamp recorded as processed_at
 
-    return completed_trip
+    Returns:
+        dict: ExpressionAttributeValues in DynamoDB wire format
+    """
+    return {
+        ":new_status": serializer.serialize(new_status),
+        ":processed_at": serializer.serialize(processed_at),
+    }
 
 
-# --- Helper Function to Update Event Status ---
-def update_event_status(item: dict, new_status: str) -> bool:
+# --- Helper Function to Build a Status Update for a Transaction ---
+def build_status_update(item: dict, status_values: dict) -> dict:
     """
-    Update the status of a DynamoDB item and mark it as processed.
+    Builds a TransactWriteItems Update that sets the status of a raw event and
+    marks it as processed. The update only applies if the event still exists.
 
     Args:
-        item (dict): The DynamoDB item to update
-        new_status (str): The new status to set for the item
+        item (dict): The raw event item whose status should change
+        status_values (dict): Marshalled values from build_status_values
 
     Returns:
-        bool: True if the status update was successful, False otherwise
+        dict: An 'Update' entry for transact_write_items
+    """
+    return {
+        "Update": {
+            "TableName": DYNAMODB_TABLE_NAME,
+            "Key": {
+                "PK": serializer.serialize(item["PK"]),
+                "SK": serializer.serialize(item["SK"]),
+            },
+            "UpdateExpression": "SET #status = :new_status, processed_at = :processed_at",
+            "ConditionExpression": "attribute_exists(PK)",
+            "ExpressionAttributeNames": {"#status": "status"},
+            "ExpressionAttributeValues": status_values,
+        }
+    }
+
+
+# --- Helper Function to Write a Completed Trip Atomically ---
+def write_completed_trip(
+    completed_trip: dict, source_events: list[dict], status_values: dict
+) -> str:
     """
+    Writes a completed trip and marks both raw events as processed in a single
+    DynamoDB transaction.
+
+    The completed trip is only written if it does not exist yet, and the status
+    updates only apply if both raw events still exist. If any condition fails
+    the whole transaction is cancelled, so a trip that was already completed,
+    for example by the counterpart's own stream record, is never written twice.
+
+    processing_timestamp_lambda2 is stamped right before the transaction. The
+    Glue job uses it as its incremental watermark, so it must trail the actual
+    commit by as little as possible (see WATERMARK_LAG_SECONDS in glue_scripts.py).
 
+    Args:
+        completed_trip (dict): The completed trip record to write
+        source_events (list[dict]): The start and end raw events of the trip
+        status_values (dict): Marshalled values from build_status_values
+
+    Returns:
+        str: "created" if the transaction succeeded, "already_completed" if the
+            completed trip already existed, "failed" otherwise
+    """
     try:
-        response = table.update_item(
-            Key={"PK": item["PK"], "SK": item["SK"]},
-            UpdateExpression="SET #status = :new_status, processed_at = :processed_at",
-            ExpressionAttributeNames={"#status": "status"},
-            ExpressionAttributeValues={
-                ":new_status": new_status,
-                ":processed_at": datetime.now(timezone.utc).isoformat(),
-            },
-            ReturnValues="NONE",
+        completed_trip["processing_timestamp_lambda2"] = datetime.now(
+            timezone.utc
+        ).isoformat()
+
+        # Marshal the item once here; the low-level client sends it as-is
+        marshalled_trip = {
+            k: serializer.serialize(v) for k, v in completed_trip.items()
+        }
+
+        dynamodb_client.transact_write_items(
+            TransactItems=[
+                {
+                    "Put": {
+                        "TableName": DYNAMODB_TABLE_NAME,
+                        "Item": marshalled_trip,
+                        "ConditionExpression": "attribute_not_exists(PK)",
+                    }
+                },
+                *(build_status_update(item, status_values) for item in source_events),
+            ]
+        )
+        return "created"
+    except dynamodb_client.exceptions.TransactionCanceledException as e:
+        reasons = [
+            reason.get("Code") for reason in e.response.get("CancellationReasons", [])
+        ]
+
+        # The Put is the first item; its condition only fails if the completed
+        # trip exists, i.e. the counterpart's stream record already won
+        if reasons and reasons[0] == "ConditionalCheckFailed":
+            return "already_completed"
+
+        print(
+            f"Transaction cancelled for completed trip {completed_trip['PK']} "
+            f"(reasons: {reasons})."
         )
-        return True
+        return "failed"
     except Exception as e:
-        print(f"Error updating status for item {item['PK']}, {item['SK']}: {e}")
-        return False
+        print(f"Error writing completed trip {completed_trip['PK']}: {e}")
+        return "failed"
 
 
-# --- Helper Function to Put Item with RetryLogic ---
-def put_item_with_retry(item: dict, max_retries: int = 3) -> bool:
+# --- Helper Function to Convert a Stream Record into an Event Item ---
+def parse_stream_record(record: dict) -> tuple[dict, str, str] | None:
     """
-    Puts an item into DynamoDB with retry logic.
+    Extracts a RAW trip event from a DynamoDB Stream record.
 
     Args:
-        item (dict): The item to put
-        max_retries (int): Maximum number of retry attempts
+        record (dict): A single DynamoDB Stream record
 
     Returns:
-        bool: True if put succeeded, False otherwise
+        tuple | None: (event_item, trip_id, data_type) for RAW 'trip_start' or
+            'trip_end' INSERT events, or None if the record should be skipped
     """
-    retry_count = 0
-    while retry_count < max_retries:
-        try:
-            response = table.put_item(Item=item)
-            return True
-        except Exception as e:
-            retry_count += 1
-            print(f"Error putting item (attempt {retry_count}/{max_retries}): {e}")
-            if retry_count >= max_retries:
-                print(f"Failed to put item after {max_retries} attempts.")
-                return False
+    # Skip non-INSERT events
+    if record["eventName"] != "INSERT":
+        print(f"Skipping non-INSERT event: {record['eventName']}")
+        return None
+
+    # Extract the new image of the item (the inserted data)
+    if "NewImage" not in record["dynamodb"]:
+        print("Skipping record: No 'NewImage' in the DynamoDB record.")
+        return None
+
+    # Convert DynamoDB format to normal Python dict
+    ddb_item = record["dynamodb"]["NewImage"]
+
+    # Extract key fields for processing
+    pk = ddb_item.get("PK", {}).get("S")
+    sk = ddb_item.get("SK", {}).get("S", "")
+
+    # Only process RAW# events
+    if not sk.startswith("RAW#"):
+        print(f"Skipping non-RAW event with SK: {sk}")
+        return None
+
+    # Extract data type ('trip_start' or 'trip_end')
+    data_type = ddb_item.get("data_type", {}).get("S")
+    if not data_type or data_type not in ["trip_start", "trip_end"]:
+        print(f"Skipping record with invalid or missing data_type: {data_type}")
+        return None
+
+    print(f"Processing {data_type} event for trip_id {pk}")
+
+    # Convert DynamoDB NewImage to regular Python dict
+    event_item = {}
+    for key, value in ddb_item.items():
+        # Handle different DynamoDB types
+        if "S" in value:
+            event_item[key] = value["S"]
+        elif "N" in value:
+            event_item[key] = Decimal(value["N"])
+        elif "BOOL" in value:
+            event_item[key] = value["BOOL"]
+        elif "NULL" in value:
+            event_item[key] = None
+        # Add other types as needed
+
+    return event_item, pk, data_type
 
 
 # --- Main Lambda Handler ---
@@ -178,12 +340,12 @@ def lambda_handler(event: dict, context: dict) -> dict:
     Lambda handler for processing DynamoDB Stream events related to trip events.
 
     This function processes INSERT events from a DynamoDB stream, matching 'trip_start' and 'trip_end'
-    events to create completed trip records. It performs the following key actions:
+    events to create completed trip records. The whole batch of records is handled together:
     - Validates the incoming event structure
     - Filters for INSERT events and RAW# events
-    - Finds and matches counterpart trip events
-    - Creates completed trip records
-    - Updates the status of processed events
+    - Finds counterpart trip events for all records concurrently
+    - Writes each completed trip together with the status updates of its raw events
+      in one transaction
 
     Args:
         event (dict): DynamoDB Stream event containing records to process
@@ -204,90 +366,74 @@ def lambda_handler(event: dict, context: dict) -> dict:
 
     print(f"Received DynamoDB Stream event with {len(event['Records'])} records.")
 
-    for record in event["Records"]:
-        # Skip non-INSERT events
-        if record["eventName"] != "INSERT":
-            print(f"Skipping non-INSERT event: {record['eventName']}")
-            continue
+    # One timestamp for the raw-event status updates of this batch; each
+    # completed trip is stamped by write_completed_trip instead
+    now_iso = datetime.now(timezone.utc).isoformat()
 
+    # 1. Parse all records first so the DynamoDB calls can be batched
+    pending = []
+    for record in event["Records"]:
         try:
-            # Extract the new image of the item (the inserted data)
-            if "NewImage" not in record["dynamodb"]:
-                print("Skipping record: No 'NewImage' in the DynamoDB record.")
-                continue
-
-            # Convert DynamoDB format to normal Python dict
-            ddb_item = record["dynamodb"]["NewImage"]
-            # Handle unmarshalling (will be done by boto3 for us in most cases)
-
-            # Extract key fields for processing
-            pk = ddb_item.get("PK", {}).get("S")
-            sk = ddb_item.get("SK", {}).get("S", "")
+            parsed = parse_stream_record(record)
+        except Exception as e:
+            print(f"Error processing record: {e}")
+            # Continue processing other records even if one fails
+            continue
 
-            # Only process RAW# events
-            if not sk.startswith("RAW#"):
-                print(f"Skipping non-RAW event with SK: {sk}")
-                continue
+        if parsed:
+            pending.append(parsed)
 
-            # Extract data type ('trip_start' or 'trip_end')
-            data_type = ddb_item.get("data_type", {}).get("S")
-            if not data_type or data_type not in ["trip_start", "trip_end"]:
-                print(f"Skipping record with invalid or missing data_type: {data_type}")
-                continue
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # 2. Look up the counterpart of every event concurrently
+        counterparts = list(
+            executor.map(lambda p: find_counterpart_event(p[1], p[2]), pending)
+        )
 
-            print(f"Processing {data_type} event for trip_id {pk}")
-
-            # Convert DynamoDB NewImage to regular Python dict
-            event_item = {}
-            for key, value in ddb_item.items():
-                # Handle different DynamoDB types
-                if "S" in value:
-                    event_item[key] = value["S"]
-                elif "N" in value:
-                    event_item[key] = Decimal(value["N"])
-                elif "BOOL" in value:
-                    event_item[key] = value["BOOL"]
-                elif "NULL" in value:
-                    event_item[key] = None
-                # Add other types as needed
-
-            # Find the counterpart event
-            counterpart_item = find_counterpart_event(pk, data_type)
-
-            if counterpart_item:
+        # 3. Create the completed trips, keeping one per PK/SK since both
+        # events of a trip can arrive in the same batch
+        completed_trips = {}
+        for (event_item, pk, data_type), counterpart_item in zip(pending, counterparts):
+            if not counterpart_item:
                 print(
-                    f"Found matching counterpart for trip_id {pk}. Creating completed trip."
+                    f"No counterpart found yet for trip_id {pk}. Waiting for the matching event."
                 )
+                continue
 
-                # Determine which is start and which is end
-                if data_type == "trip_start":
-                    start_event = event_item
-                    end_event = counterpart_item
-                else:
-                    start_event = counterpart_item
-                    end_event = event_item
+            print(
+                f"Found matching counterpart for trip_id {pk}. Creating completed trip."
+            )
 
-                # Create and write the completed trip
-                completed_trip = create_completed_trip(start_event, end_event)
-                if put_item_with_retry(completed_trip):
-                    print(
-                        f"Successfully created completed trip record for trip_id {pk}"
-                    )
-
-                    # Update the status of both raw events to mark them as processed
-                    update_event_status(event_item, "processed_by_matcher")
-                    update_event_status(counterpart_item, "processed_by_matcher")
-                else:
-                    print(f"Failed to create completed trip record for trip_id {pk}")
+            # Determine which is start and which is end
+            if data_type == "trip_start":
+                start_event = event_item
+                end_event = counterpart_item
             else:
-                print(
-                    f"No counterpart found yet for trip_id {pk}. Waiting for the matching event."
-                )
+                start_event = counterpart_item
+                end_event = event_item
 
-        except Exception as e:
-            print(f"Error processing record: {e}")
-            # Continue processing other records even if one fails
-            continue
+            try:
+                completed_trip = create_completed_trip(start_event, end_event)
+            except Exception as e:
+                print(f"Error creating completed trip for trip_id {pk}: {e}")
+                continue
+
+            key = (completed_trip["PK"], completed_trip["SK"])
+            if key not in completed_trips:
+                completed_trips[key] = (completed_trip, [event_item, counterpart_item])
+
+        # 4. Write each completed trip and both status updates atomically
+        status_values = build_status_values("processed_by_matcher", now_iso)
+        results = executor.map(
+            lambda entry: write_completed_trip(entry[0], entry[1], status_values),
+            completed_trips.values(),
+        )
+        for (pk, _), result in zip(completed_trips, results):
+            if result == "created":
+                print(f"Successfully created completed trip record for trip_id {pk}")
+            elif result == "already_completed":
+                print(f"Completed trip record for trip_id {pk} already exists.")
+            else:
+                print(f"Failed to create completed trip record for trip_id {pk}")
 
     return {
         "statusCode": 200,